@@ -1,90 +1,518 @@
 from flask import Flask, render_template, request, jsonify, Response, send_file
 import io
+import math
+from math import expm1, log1p
+import tempfile
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+import msgspec
+import numpy as np
+import orjson
+from numba import njit, prange
 from datetime import datetime
 
 app = Flask(__name__)
 
-def build_amortization_schedule(loan_amount, years, interest_rate, prepayments=None, strategy='reduce_term'):
-    prepayments = prepayments or []
-    prepay_map = {int(p.get('month', 0)): float(p.get('amount', 0)) for p in prepayments if float(p.get('amount', 0)) > 0}
+SCHEDULE_FIELDS = ('month', 'payment', 'principal', 'interest', 'extra', 'remaining_balance')
+
+@dataclass(frozen=True)
+class Schedule:
+    # График хранится по столбцам: по одному массиву на каждое поле строки
+    months: np.ndarray
+    payment: np.ndarray
+    principal: np.ndarray
+    interest: np.ndarray
+    extra: np.ndarray
+    balance: np.ndarray
+
+    def __post_init__(self):
+        # График разделяется между запросами через кэш, поэтому массивы только для чтения
+        for column in self.columns():
+            column.flags.writeable = False
+
+    def __len__(self):
+        return len(self.months)
+
+    def columns(self):
+        return self.months, self.payment, self.principal, self.interest, self.extra, self.balance
+
+    def to_rows(self, limit=None):
+        # Словари строк нужны только для JSON-ответа
+        columns = (column[:limit].tolist() for column in self.columns())
+        return [dict(zip(SCHEDULE_FIELDS, row)) for row in zip(*columns)]
+
+class Prepayment(msgspec.Struct):
+    month: int = 0
+    amount: float = 0.0
+
+class CalcInput(msgspec.Struct):
+    # null в необязательных полях разрешен, как и раньше при разборе через data.get()
+    loan_amount: float
+    years: int
+    installment: Optional[bool] = False
+    interest_rate: Optional[float] = 0.0
+    prepayments: Optional[list[Prepayment]] = None
+    strategy: Optional[str] = 'reduce_term'
+
+class BatchInput(msgspec.Struct):
+    scenarios: list[CalcInput]
+
+MAX_BATCH_SCENARIOS = 50
+
+# Допустимые входные данные: срок как в форме (до 50 лет), ставка до 40% годовых.
+# В этих пределах итоги без графика (build_annuity_summary) совпадают с полным графиком
+MAX_YEARS = 50
+MAX_INTEREST_RATE = 40
+
+# 50 лет — 600 строк, около 30 КБ на запись кэша; 256 записей укладываются в ~8 МБ
+MAX_CACHED_YEARS = 50
+
+# Ширина столбцов Excel известна заранее: месяц не длиннее 5 знаков,
+# суммы — до 15; по ячейкам для подбора ширины не проходим
+XLSX_SCHEDULE_WIDTHS = {'A': 8, 'B': 14, 'C': 16, 'D': 12, 'E': 18, 'F': 18}
+XLSX_TOTALS_WIDTHS = {'A': 20, 'B': 14}
+
+REDUCE_TERM = 0
+REDUCE_PAYMENT = 1
+STRATEGY_CODES = {'reduce_term': REDUCE_TERM, 'reduce_payment': REDUCE_PAYMENT}
+
+# Слой потоков numba по умолчанию (workqueue) не допускает параллельных вызовов
+# prange-ядра из нескольких потоков сервера
+_batch_lock = threading.Lock()
+
+def _closed_form_balances(balance, monthly_rate, monthly_payment, k):
+    # Остаток после k-го платежа при постоянном платеже считается в замкнутой форме:
+    # B_k = B_0 * (1 + r)^k - P * ((1 + r)^k - 1) / r
+    if monthly_rate > 0:
+        # (1 + r)^k - 1 через expm1/log1p точнее при малых ставках
+        growth_m1 = np.expm1(k * np.log1p(monthly_rate))
+        return balance * (growth_m1 + 1.0) - monthly_payment * growth_m1 / monthly_rate
+    return balance - monthly_payment * k
+
+def _payoff_month(balance, monthly_rate, monthly_payment, count):
+    # Номер месяца, в котором остаток впервые не больше 0.005 (тот же порог, что и
+    # в _annuity_segment), находим за O(1) решением B_k <= 0.005 относительно k.
+    # Совпадение с _annuity_segment проверено для ставок до MAX_INTEREST_RATE и сроков
+    # до MAX_YEARS; при больших ставках остаток в замкнутой форме зашумлен, и поиск
+    # может остановиться не на первом пересечении порога
+    if monthly_rate > 0:
+        target = monthly_payment / monthly_rate
+        if target <= balance:
+            return count
+        if target <= 0.005:
+            return 1
+        k = math.ceil(math.log((target - 0.005) / (target - balance)) / log1p(monthly_rate))
+    else:
+        k = math.ceil((balance - 0.005) / monthly_payment)
+    k = min(max(k, 1), count)
+
+    # Уточняем на соседних месяцах по тому же выражению, что и в векторном расчете
+    def paid_off(month):
+        return _closed_form_balances(balance, monthly_rate, monthly_payment, np.array([month]))[0] <= 0.005
+
+    while k > 1 and paid_off(k - 1):
+        k -= 1
+    while k < count and not paid_off(k):
+        k += 1
+    return k
 
+def _annuity_segment(balance, monthly_rate, monthly_payment, count):
+    balances = _closed_form_balances(balance, monthly_rate, monthly_payment, np.arange(1, count + 1))
+
+    # Обрезаем сегмент на месяце, когда долг погашен
+    paid_off = np.flatnonzero(balances <= 0.005)
+    if paid_off.size:
+        balances = balances[:paid_off[0] + 1]
+
+    previous = np.concatenate(([balance], balances[:-1]))
+    interest = previous * monthly_rate
+    principal = monthly_payment - interest
+    return principal, interest, np.maximum(balances, 0.0)
+
+def _annuity_payment(balance, monthly_rate, payments):
+    if monthly_rate == 0:
+        return balance / payments
+    # factor - 1 = expm1(n * log1p(r)) без потери точности при r близком к нулю
+    try:
+        factor_m1 = expm1(payments * log1p(monthly_rate))
+    except OverflowError:
+        raise ValueError('Расчет невозможен при таких параметрах') from None
+    return balance * (monthly_rate * (factor_m1 + 1.0)) / factor_m1
+
+def _closed_form_schedule(loan_amount, monthly_rate, monthly_payment, count):
+    principal, interest, balance = _annuity_segment(loan_amount, monthly_rate, monthly_payment, count)
+    return Schedule(
+        np.arange(1, len(balance) + 1),
+        np.round(principal + interest, 2),
+        np.round(principal, 2),
+        np.round(interest, 2),
+        np.zeros(len(balance)),
+        np.round(balance, 2)
+    )
+
+def build_annuity_summary(loan_amount, years, interest_rate, months=12):
+    # Итоги без досрочных платежей считаются по формуле аннуитета,
+    # график строится только для первых `months` месяцев
     monthly_rate = interest_rate / 100 / 12
     total_payments = years * 12
 
     if total_payments <= 0:
         raise ValueError('Срок должен быть положительным')
 
+    monthly_payment = _annuity_payment(loan_amount, monthly_rate, total_payments)
+    # Число платежей — как у полного графика, который останавливается на погашении долга
+    total_payments = _payoff_month(loan_amount, monthly_rate, monthly_payment, total_payments)
+    schedule = _closed_form_schedule(loan_amount, monthly_rate, monthly_payment, min(months, total_payments))
+    total_paid = monthly_payment * total_payments
+    overpayment = total_paid - loan_amount
+
+    return schedule, monthly_payment, total_paid, overpayment, total_payments
+
+@njit(cache=True, fastmath={'nsz'})
+def _amort_loop_annuity(loan_amount, monthly_rate, total_payments, prepay_months, prepay_amounts, strategy_code):
     # Рассчитываем первоначальный платеж
-    if monthly_rate == 0:
-        monthly_payment = loan_amount / total_payments
-    else:
-        factor = (1 + monthly_rate) ** total_payments
-        monthly_payment = loan_amount * (monthly_rate * factor) / (factor - 1)
+    growth_log = log1p(monthly_rate)
+    factor_m1 = expm1(total_payments * growth_log)
+    monthly_payment = loan_amount * (monthly_rate * (factor_m1 + 1.0)) / factor_m1
+
+    # prepay_months отсортированы по возрастанию: вместо поиска по месяцу двигаем курсор,
+    # начальную позицию (первый месяц >= 1) находим бинарным поиском
+    cursor = np.searchsorted(prepay_months, 1)
+
+    months = np.empty(total_payments, dtype=np.int64)
+    payment = np.empty(total_payments)
+    principal = np.empty(total_payments)
+    interest = np.empty(total_payments)
+    extra = np.empty(total_payments)
+    balance = np.empty(total_payments)
 
-    schedule = []
     remaining_balance = loan_amount
-    current_payment_index = 0
+    total_pay = 0.0
+    total_extra = 0.0
+    n = 0
 
-    while remaining_balance > 0 and current_payment_index < 1000 * total_payments:
-        current_payment_index += 1
-        interest_payment = remaining_balance * monthly_rate if monthly_rate > 0 else 0.0
+    while remaining_balance > 0 and n < total_payments:
+        interest_payment = remaining_balance * monthly_rate
         principal_payment = monthly_payment - interest_payment
-        if principal_payment <= 0 and monthly_rate > 0:
+        if principal_payment <= 0:
             # защита от бесконечного цикла при экстремальных значениях
             principal_payment = 0.01
         remaining_balance = max(0.0, remaining_balance - principal_payment)
 
         # Досрочный платеж в этом месяце (после основного платежа)
-        extra = prepay_map.get(current_payment_index, 0.0)
-        if extra > 0 and remaining_balance > 0:
-            remaining_balance = max(0.0, remaining_balance - extra)
-            if strategy == 'reduce_payment' and remaining_balance > 0:
+        extra_payment = 0.0
+        if cursor < prepay_months.size and prepay_months[cursor] == n + 1:
+            extra_payment = prepay_amounts[cursor]
+            cursor += 1
+        if extra_payment > 0 and remaining_balance > 0:
+            remaining_balance = max(0.0, remaining_balance - extra_payment)
+            if strategy_code == REDUCE_PAYMENT and remaining_balance > 0:
+                # пересчитываем ежемесячный платеж на оставшийся срок; множитель считаем
+                # заново (только в месяцы досрочных платежей), а не накапливаем помесячно,
+                # чтобы погрешность не росла с длиной срока
+                payments_left = max(1, total_payments - (n + 1))
+                factor_left_m1 = expm1(payments_left * growth_log)
+                monthly_payment = remaining_balance * (monthly_rate * (factor_left_m1 + 1.0)) / factor_left_m1
+            # REDUCE_TERM — платеж оставляем прежним, срок сократится автоматически
+
+        months[n] = n + 1
+        payment[n] = principal_payment + interest_payment
+        principal[n] = principal_payment
+        interest[n] = interest_payment
+        extra[n] = extra_payment
+        balance[n] = remaining_balance
+        total_pay += principal_payment + interest_payment
+        total_extra += extra_payment
+        n += 1
+
+        if remaining_balance <= 0.005:
+            break
+
+    # Цикл ограничен сроком кредита: остаток, накопленный погрешностью при высоких
+    # ставках, доплачивается в последнем месяце, а не пропадает из графика
+    if n > 0 and remaining_balance > 0.005:
+        payment[n - 1] += remaining_balance
+        principal[n - 1] += remaining_balance
+        balance[n - 1] = 0.0
+        total_pay += remaining_balance
+
+    return months[:n], payment[:n], principal[:n], interest[:n], extra[:n], balance[:n], monthly_payment, total_pay + total_extra
+
+@njit(cache=True, fastmath={'nsz'})
+def _amort_loop_installment(loan_amount, total_payments, prepay_months, prepay_amounts, strategy_code):
+    # Рассрочка (0%): процентов нет, весь платеж идет в основной долг
+    monthly_payment = loan_amount / total_payments
+
+    cursor = np.searchsorted(prepay_months, 1)
+
+    months = np.empty(total_payments, dtype=np.int64)
+    payment = np.empty(total_payments)
+    principal = np.empty(total_payments)
+    interest = np.zeros(total_payments)
+    extra = np.empty(total_payments)
+    balance = np.empty(total_payments)
+
+    remaining_balance = loan_amount
+    total_pay = 0.0
+    total_extra = 0.0
+    n = 0
+
+    while remaining_balance > 0 and n < total_payments:
+        principal_payment = monthly_payment
+        remaining_balance = max(0.0, remaining_balance - principal_payment)
+
+        # Досрочный платеж в этом месяце (после основного платежа)
+        extra_payment = 0.0
+        if cursor < prepay_months.size and prepay_months[cursor] == n + 1:
+            extra_payment = prepay_amounts[cursor]
+            cursor += 1
+        if extra_payment > 0 and remaining_balance > 0:
+            remaining_balance = max(0.0, remaining_balance - extra_payment)
+            if strategy_code == REDUCE_PAYMENT and remaining_balance > 0:
                 # пересчитываем ежемесячный платеж на оставшийся срок
-                payments_left = max(1, total_payments - current_payment_index)
-                if monthly_rate == 0:
-                    monthly_payment = remaining_balance / payments_left
-                else:
-                    factor_left = (1 + monthly_rate) ** payments_left
-                    monthly_payment = remaining_balance * (monthly_rate * factor_left) / (factor_left - 1)
-            # strategy == 'reduce_term' — платеж оставляем прежним, срок сократится автоматически
-
-        schedule.append({
-            'month': current_payment_index,
-            'payment': round(principal_payment + interest_payment, 2),
-            'principal': round(principal_payment, 2),
-            'interest': round(interest_payment, 2),
-            'extra': round(extra, 2),
-            'remaining_balance': round(remaining_balance, 2)
-        })
+                monthly_payment = remaining_balance / max(1, total_payments - (n + 1))
+            # REDUCE_TERM — платеж оставляем прежним, срок сократится автоматически
+
+        months[n] = n + 1
+        payment[n] = principal_payment
+        principal[n] = principal_payment
+        extra[n] = extra_payment
+        balance[n] = remaining_balance
+        total_pay += principal_payment
+        total_extra += extra_payment
+        n += 1
 
         if remaining_balance <= 0.005:
-            remaining_balance = 0.0
             break
 
-    total_paid = sum(r['payment'] for r in schedule) + sum(r['extra'] for r in schedule)
+    # Цикл ограничен сроком кредита: остаток, накопленный погрешностью при высоких
+    # ставках, доплачивается в последнем месяце, а не пропадает из графика
+    if n > 0 and remaining_balance > 0.005:
+        payment[n - 1] += remaining_balance
+        principal[n - 1] += remaining_balance
+        balance[n - 1] = 0.0
+        total_pay += remaining_balance
+
+    return months[:n], payment[:n], principal[:n], interest[:n], extra[:n], balance[:n], monthly_payment, total_pay + total_extra
+
+@njit(cache=True)
+def _amort_core(loan_amount, monthly_rate, total_payments, prepay_months, prepay_amounts, strategy_code):
+    # Ставка — инвариант цикла: выбираем специализированный цикл один раз, а не каждый месяц
+    if monthly_rate == 0.0:
+        return _amort_loop_installment(loan_amount, total_payments, prepay_months, prepay_amounts, strategy_code)
+    return _amort_loop_annuity(loan_amount, monthly_rate, total_payments, prepay_months, prepay_amounts, strategy_code)
+
+@njit(cache=True, parallel=True)
+def _amort_batch(loan_amounts, monthly_rates, total_payments, prepay_offsets, prepay_months, prepay_amounts, strategy_codes):
+    # Сценарии независимы, поэтому считаются параллельно по ядрам.
+    # Досрочные платежи сценария i: prepay_months[prepay_offsets[i]:prepay_offsets[i + 1]]
+    count = loan_amounts.size
+    results = np.zeros((count, total_payments.max(), 6))
+    lengths = np.zeros(count, dtype=np.int64)
+    monthly_payments = np.empty(count)
+    totals = np.empty(count)
+
+    for i in prange(count):
+        start, stop = prepay_offsets[i], prepay_offsets[i + 1]
+        months, payment, principal, interest, extra, balance, monthly_payment, total_paid = _amort_core(
+            loan_amounts[i], monthly_rates[i], total_payments[i],
+            prepay_months[start:stop], prepay_amounts[start:stop], strategy_codes[i]
+        )
+        n = months.size
+        results[i, :n, 0] = months
+        results[i, :n, 1] = payment
+        results[i, :n, 2] = principal
+        results[i, :n, 3] = interest
+        results[i, :n, 4] = extra
+        results[i, :n, 5] = balance
+        lengths[i] = n
+        monthly_payments[i] = monthly_payment
+        totals[i] = total_paid
+
+    return results, lengths, monthly_payments, totals
+
+def _prepayment_items(prepayments):
+    # Досрочные платежи как отсортированный по месяцу кортеж (месяц, сумма);
+    # при повторе месяца действует последний платеж
+    prepay_map = {int(p.get('month', 0)): float(p.get('amount', 0)) for p in prepayments or [] if float(p.get('amount', 0)) > 0}
+    return tuple(sorted(prepay_map.items()))
+
+def _rounded_schedule(months, payment, principal, interest, extra, balance):
+    # Циклы работают с полной точностью, до копеек округляем один раз на выходе
+    for column in (payment, principal, interest, extra, balance):
+        np.round(column, 2, out=column)
+    return Schedule(months, payment, principal, interest, extra, balance)
+
+def _check_finite(monthly_payment, total_paid):
+    # При экстремальной ставке скомпилированный цикл не падает, а дает inf/nan
+    if not (math.isfinite(monthly_payment) and math.isfinite(total_paid)):
+        raise ValueError('Расчет невозможен при таких параметрах')
+
+def build_amortization_schedule(loan_amount, years, interest_rate, prepayments=None, strategy='reduce_term'):
+    prepay_items = _prepayment_items(prepayments)
+
+    monthly_rate = interest_rate / 100 / 12
+    total_payments = years * 12
+
+    if total_payments <= 0:
+        raise ValueError('Срок должен быть положительным')
+
+    if prepay_items:
+        # Досрочные платежи меняют платеж или срок — считаем скомпилированным циклом
+        prepay_months, prepay_amounts = zip(*prepay_items)
+        months, payment, principal, interest, extra, balance, monthly_payment, total_paid = _amort_core(
+            float(loan_amount),
+            monthly_rate,
+            total_payments,
+            np.array(prepay_months, dtype=np.int64),
+            np.array(prepay_amounts, dtype=np.float64),
+            STRATEGY_CODES.get(strategy, REDUCE_TERM)
+        )
+        schedule = _rounded_schedule(months, payment, principal, interest, extra, balance)
+    else:
+        # Без досрочных платежей график целиком считается в замкнутой форме
+        monthly_payment = _annuity_payment(loan_amount, monthly_rate, total_payments)
+        schedule = _closed_form_schedule(loan_amount, monthly_rate, monthly_payment, total_payments)
+        total_paid = monthly_payment * len(schedule)
+
+    _check_finite(monthly_payment, total_paid)
     overpayment = total_paid - loan_amount
 
     return schedule, monthly_payment, total_paid, overpayment
 
-def calculate_mortgage(loan_amount, years, interest_rate, prepayments=None, strategy='reduce_term'):
-    full_schedule, monthly_payment, total_payment, overpayment = build_amortization_schedule(
+@lru_cache(maxsize=256)
+def _calculate_mortgage_cached(loan_amount, years, interest_rate, prepayments, strategy):
+    # Результат полностью определяется входными данными, поэтому инвалидация не нужна
+    return build_amortization_schedule(
         loan_amount=loan_amount,
         years=years,
         interest_rate=interest_rate,
-        prepayments=prepayments,
+        prepayments=[{'month': month, 'amount': amount} for month, amount in prepayments],
         strategy=strategy
     )
-    short_schedule = full_schedule[:12]
+
+def _mortgage_result(loan_amount, schedule, monthly_payment, total_payment, overpayment, total_payments):
     return {
         'monthly_payment': round(monthly_payment, 2),
         'total_payment': round(total_payment, 2),
         'overpayment': round(overpayment, 2),
         'overpayment_percentage': round((overpayment / loan_amount) * 100, 2) if loan_amount > 0 else 0.0,
-        'payment_schedule': short_schedule,
-        'full_schedule': full_schedule,
-        'total_payments': len(full_schedule)
+        'schedule': schedule,
+        'total_payments': total_payments
     }
 
+def calculate_mortgage(loan_amount, years, interest_rate, prepayments=None, strategy='reduce_term', full=True):
+    # Ключ кэша должен быть хешируемым: досрочные платежи приводим к отсортированному кортежу
+    prepay_items = _prepayment_items(prepayments)
+    if not full and not prepay_items:
+        schedule, monthly_payment, total_payment, overpayment, total_payments = build_annuity_summary(
+            loan_amount, years, interest_rate
+        )
+    else:
+        # Без досрочных платежей стратегия ни на что не влияет, а неизвестная работает
+        # как reduce_term: приводим ее, чтобы один результат не кэшировался дважды
+        if not prepay_items or strategy != 'reduce_payment':
+            strategy = 'reduce_term'
+        # lru_cache ограничивает число записей, но не их размер: длинные графики не кэшируем
+        compute = _calculate_mortgage_cached if years <= MAX_CACHED_YEARS else _calculate_mortgage_cached.__wrapped__
+        schedule, monthly_payment, total_payment, overpayment = compute(
+            loan_amount, years, interest_rate, prepay_items, strategy
+        )
+        total_payments = len(schedule)
+    return _mortgage_result(loan_amount, schedule, monthly_payment, total_payment, overpayment, total_payments)
+
+def calculate_mortgage_batch(scenarios):
+    # Несколько сценариев (например, сравнение стратегий и ставок) считаются одним
+    # параллельным вызовом; сценарий — словарь с аргументами calculate_mortgage
+    total_payments = np.array([s['years'] * 12 for s in scenarios], dtype=np.int64)
+    if (total_payments <= 0).any():
+        raise ValueError('Срок должен быть положительным')
+    # Ядро выделяет массив (сценарии × самый длинный срок × 6), поэтому срок ограничен
+    if (total_payments > MAX_YEARS * 12).any():
+        raise ValueError(f'Срок — не более {MAX_YEARS} лет')
+
+    loan_amounts = np.array([s['loan_amount'] for s in scenarios], dtype=np.float64)
+    prepay_items = [_prepayment_items(s.get('prepayments')) for s in scenarios]
+    flat_items = [item for items in prepay_items for item in items]
+
+    with _batch_lock:
+        results, lengths, monthly_payments, totals = _amort_batch(
+            loan_amounts,
+            np.array([s['interest_rate'] / 100 / 12 for s in scenarios], dtype=np.float64),
+            total_payments,
+            np.cumsum([0] + [len(items) for items in prepay_items]).astype(np.int64),
+            np.array([month for month, _ in flat_items], dtype=np.int64),
+            np.array([amount for _, amount in flat_items], dtype=np.float64),
+            np.array([STRATEGY_CODES.get(s.get('strategy', 'reduce_term'), REDUCE_TERM) for s in scenarios], dtype=np.int64)
+        )
+
+    output = []
+    for i, loan_amount in enumerate(loan_amounts.tolist()):
+        rows = results[i, :lengths[i]]
+        schedule = _rounded_schedule(rows[:, 0].astype(np.int64), *(rows[:, col] for col in range(1, 6)))
+        total_payment = float(totals[i])
+        _check_finite(monthly_payments[i], total_payment)
+        output.append(_mortgage_result(
+            loan_amount, schedule, float(monthly_payments[i]), total_payment, total_payment - loan_amount, len(schedule)
+        ))
+    return output
+
+def fast_jsonify(obj):
+    # orjson сериализует большой full_schedule в разы быстрее стандартного json
+    return Response(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY), mimetype='application/json')
+
+def _calc_args(data):
+    if data.installment:
+        interest_rate = 0.0
+    elif data.interest_rate is None:
+        raise ValueError('Не указана процентная ставка')
+    else:
+        interest_rate = data.interest_rate
+    prepayments = [{'month': p.month, 'amount': p.amount} for p in data.prepayments or []]
+    return data.loan_amount, data.years, interest_rate, prepayments, data.strategy or 'reduce_term'
+
+def _is_true(value):
+    return value.lower() == 'true'
+
+def _typed_arg(args, key, type, default=None):
+    # args.get(type=...) при ошибке приведения молча возвращает default, а неверный
+    # параметр должен давать ошибку, а не файл с неверным графиком
+    if key not in args:
+        if default is None:
+            raise ValueError(f'Не указан параметр {key}')
+        return default
+    value = args.get(key, type=type)
+    if value is None:
+        raise ValueError(f'Неверное значение параметра {key}')
+    return value
+
+def _validation_error(loan_amount, years, interest_rate):
+    if loan_amount <= 0 or years <= 0 or interest_rate < 0:
+        return 'Все значения должны быть положительными'
+    if years > MAX_YEARS or interest_rate > MAX_INTEREST_RATE:
+        return f'Срок — не более {MAX_YEARS} лет, ставка — не более {MAX_INTEREST_RATE}%'
+    return None
+
+def parse_common_args(args):
+    # Общие параметры выгрузок CSV/Excel; приведение типов делает Werkzeug
+    loan_amount = _typed_arg(args, 'loan_amount', float)
+    years = _typed_arg(args, 'years', int)
+    installment = args.get('installment', False, type=_is_true)
+    interest_rate = 0.0 if installment else _typed_arg(args, 'interest_rate', float, 0.0)
+    strategy = args.get('strategy', 'reduce_term')
+    # простая форма: один досрочный платеж; пустое поле, как и раньше, означает «нет платежа»
+    prepay_amount = _typed_arg(args, 'prepay_amount', float, 0.0) if args.get('prepay_amount') else 0.0
+    prepay_month = _typed_arg(args, 'prepay_month', int, 0) if args.get('prepay_month') else 0
+    error = _validation_error(loan_amount, years, interest_rate)
+    if error:
+        raise ValueError(error)
+    prepayments = []
+    if prepay_amount > 0 and prepay_month > 0:
+        prepayments.append({'month': prepay_month, 'amount': prepay_amount})
+    return loan_amount, years, interest_rate, strategy, prepayments
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -92,21 +520,60 @@ def index():
 @app.route('/calculate', methods=['POST'])
 def calculate():
     try:
-        data = request.get_json(force=True)
-        loan_amount = float(data['loan_amount'])
-        years = int(data['years'])
-        installment = bool(data.get('installment', False))
-        interest_rate = 0.0 if installment else float(data.get('interest_rate', 0.0))
-        prepayments = data.get('prepayments', [])
-        strategy = data.get('strategy', 'reduce_term')
-
-        if loan_amount <= 0 or years <= 0 or interest_rate < 0:
-            return jsonify({'error': 'Все значения должны быть положительными'}), 400
-
-        result = calculate_mortgage(loan_amount, years, interest_rate, prepayments, strategy)
-        return jsonify(result)
+        # strict=False сохраняет прежнее поведение float()/int(): числа можно передавать строками
+        data = msgspec.json.decode(request.get_data(), type=CalcInput, strict=False)
+        loan_amount, years, interest_rate, prepayments, strategy = _calc_args(data)
+
+        error = _validation_error(loan_amount, years, interest_rate)
+        if error:
+            return jsonify({'error': error}), 400
+
+        # Полный график нужен только для диаграммы: без full=true отдаем итоги и первые 12 месяцев
+        full = request.args.get('full', False, type=_is_true)
+        result = calculate_mortgage(loan_amount, years, interest_rate, prepayments, strategy, full=full)
+        schedule = result.pop('schedule')
+        result['payment_schedule'] = schedule.to_rows(12)
+        if full:
+            result['full_schedule'] = schedule.to_rows()
+        return fast_jsonify(result)
+
+    except (msgspec.DecodeError, ValueError, KeyError, TypeError):
+        return jsonify({'error': 'Неверные данные'}), 400
+    except Exception:
+        return jsonify({'error': 'Ошибка расчета'}), 500
 
-    except (ValueError, KeyError, TypeError):
+@app.route('/calculate-batch', methods=['POST'])
+def calculate_batch():
+    try:
+        data = msgspec.json.decode(request.get_data(), type=BatchInput, strict=False)
+        if not data.scenarios or len(data.scenarios) > MAX_BATCH_SCENARIOS:
+            return jsonify({'error': f'Допускается от 1 до {MAX_BATCH_SCENARIOS} сценариев'}), 400
+
+        scenarios = []
+        for item in data.scenarios:
+            loan_amount, years, interest_rate, prepayments, strategy = _calc_args(item)
+            error = _validation_error(loan_amount, years, interest_rate)
+            if error:
+                return jsonify({'error': error}), 400
+            scenarios.append({
+                'loan_amount': loan_amount,
+                'years': years,
+                'interest_rate': interest_rate,
+                'prepayments': prepayments,
+                'strategy': strategy
+            })
+
+        # Полные графики всех сценариев отдаем только по запросу (full=true), как и в /calculate
+        full = request.args.get('full', False, type=_is_true)
+        results = calculate_mortgage_batch(scenarios)
+        for result in results:
+            schedule = result.pop('schedule')
+            result['payment_schedule'] = schedule.to_rows(12)
+            if full:
+                result['full_schedule'] = schedule.to_rows()
+        return fast_jsonify({'results': results})
+
+    except (msgspec.DecodeError, ValueError, KeyError, TypeError):
         return jsonify({'error': 'Неверные данные'}), 400
     except Exception:
         return jsonify({'error': 'Ошибка расчета'}), 500
@@ -114,92 +581,78 @@ def calculate():
 @app.route('/download-csv')
 def download_csv():
     try:
-        loan_amount = float(request.args.get('loan_amount', ''))
-        years = int(request.args.get('years', ''))
-        installment = request.args.get('installment', 'false').lower() == 'true'
-        interest_rate = 0.0 if installment else float(request.args.get('interest_rate', '0'))
-        strategy = request.args.get('strategy', 'reduce_term')
-        # простая форма: один досрочный платеж
-        prepay_amount = float(request.args.get('prepay_amount', '0') or 0)
-        prepay_month = int(request.args.get('prepay_month', '0') or 0)
-        prepayments = []
-        if prepay_amount > 0 and prepay_month > 0:
-            prepayments.append({'month': prepay_month, 'amount': prepay_amount})
+        loan_amount, years, interest_rate, strategy, prepayments = parse_common_args(request.args)
 
         result = calculate_mortgage(loan_amount, years, interest_rate, prepayments, strategy)
-        schedule = result['full_schedule']
+        schedule = result['schedule']
 
-        lines = ['Месяц,Платеж,Основной долг,Проценты,Досрочный платеж,Остаток долга']
-        for row in schedule:
-            lines.append(f"{row['month']},{row['payment']},{row['principal']},{row['interest']},{row['extra']},{row['remaining_balance']}")
-        csv_content = '\n'.join(lines)
+        buf = io.BytesIO()
+        np.savetxt(
+            buf,
+            np.column_stack(schedule.columns()),
+            fmt='%d,%.2f,%.2f,%.2f,%.2f,%.2f',
+            header='Месяц,Платеж,Основной долг,Проценты,Досрочный платеж,Остаток долга',
+            comments='',
+            encoding='utf-8'
+        )
 
         filename = f"mortgage_{int(loan_amount)}_{years}y_{interest_rate}pct_{strategy}.csv"
-        return Response(csv_content, mimetype='text/csv; charset=utf-8', headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+        return Response(buf.getvalue(), mimetype='text/csv; charset=utf-8', headers={'Content-Disposition': f'attachment; filename="{filename}"'})
     except Exception:
         return jsonify({'error': 'Не удалось сформировать CSV'}), 500
 
 @app.route('/download-xlsx')
 def download_xlsx():
+    tmp = None
     try:
-        from openpyxl import Workbook
-        from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-
-        loan_amount = float(request.args.get('loan_amount', ''))
-        years = int(request.args.get('years', ''))
-        installment = request.args.get('installment', 'false').lower() == 'true'
-        interest_rate = 0.0 if installment else float(request.args.get('interest_rate', '0'))
-        strategy = request.args.get('strategy', 'reduce_term')
-        prepay_amount = float(request.args.get('prepay_amount', '0') or 0)
-        prepay_month = int(request.args.get('prepay_month', '0') or 0)
-        prepayments = []
-        if prepay_amount > 0 and prepay_month > 0:
-            prepayments.append({'month': prepay_month, 'amount': prepay_amount})
+        import xlsxwriter
+
+        loan_amount, years, interest_rate, strategy, prepayments = parse_common_args(request.args)
 
         result = calculate_mortgage(loan_amount, years, interest_rate, prepayments, strategy)
-        schedule = result['full_schedule']
+        schedule = result['schedule']
 
-        wb = Workbook()
-        ws = wb.active
-        ws.title = 'График платежей'
+        # Книга до 1 МБ остается в памяти, более крупная уходит во временный файл на диске
+        tmp = tempfile.SpooledTemporaryFile(max_size=1024 * 1024, suffix='.xlsx')
+        # constant_memory: строки сразу сбрасываются на диск, модель книги не держится в памяти
+        wb = xlsxwriter.Workbook(tmp, {'constant_memory': True})
+        ws = wb.add_worksheet('График платежей')
+        header_format = wb.add_format({'bold': True, 'bg_color': '#DDD6FE', 'align': 'center'})
 
         headers = ['Месяц', 'Платеж', 'Основной долг', 'Проценты', 'Досрочный платеж', 'Остаток долга']
-        ws.append(headers)
-        header_fill = PatternFill('solid', fgColor='DDD6FE')
-        header_font = Font(bold=True)
-        for col in range(1, len(headers) + 1):
-            ws.cell(row=1, column=col).fill = header_fill
-            ws.cell(row=1, column=col).font = header_font
-            ws.cell(row=1, column=col).alignment = Alignment(horizontal='center')
+        ws.write_row(0, 0, headers, header_format)
+        for col, width in XLSX_SCHEDULE_WIDTHS.items():
+            ws.set_column(f'{col}:{col}', width)
 
-        for r in schedule:
-            ws.append([r['month'], r['payment'], r['principal'], r['interest'], r['extra'], r['remaining_balance']])
+        for r, row in enumerate(zip(*(column.tolist() for column in schedule.columns())), start=1):
+            ws.write_row(r, 0, row)
 
         # Итоги на отдельной вкладке
-        ws2 = wb.create_sheet('Итоги')
-        ws2.append(['Ежемесячный платеж', result['monthly_payment']])
-        ws2.append(['Всего выплат', result['total_payment']])
-        ws2.append(['Переплата', result['overpayment']])
-        ws2.append(['% переплаты', result['overpayment_percentage']])
-
-        for sheet in (ws, ws2):
-            for col in sheet.columns:
-                max_length = 0
-                col_letter = col[0].column_letter
-                for cell in col:
-                    try:
-                        max_length = max(max_length, len(str(cell.value)))
-                    except Exception:
-                        pass
-                sheet.column_dimensions[col_letter].width = max(12, min(32, max_length + 2))
-
-        buf = io.BytesIO()
-        wb.save(buf)
-        buf.seek(0)
+        ws2 = wb.add_worksheet('Итоги')
+        for col, width in XLSX_TOTALS_WIDTHS.items():
+            ws2.set_column(f'{col}:{col}', width)
+        totals = [
+            ('Ежемесячный платеж', result['monthly_payment']),
+            ('Всего выплат', result['total_payment']),
+            ('Переплата', result['overpayment']),
+            ('% переплаты', result['overpayment_percentage'])
+        ]
+        for r, row in enumerate(totals):
+            ws2.write_row(r, 0, row)
+
+        wb.close()
+        # Для SpooledTemporaryFile Werkzeug не знает размер, поэтому Content-Length ставим сами
+        size = tmp.tell()
+        tmp.seek(0)
 
         filename = f"mortgage_{int(loan_amount)}_{years}y_{interest_rate}pct_{strategy}.xlsx"
-        return send_file(buf, as_attachment=True, download_name=filename, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        response = send_file(tmp, as_attachment=True, download_name=filename, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        response.content_length = size
+        # Размер известен только здесь, поэтому Range-запросы обрабатываем после send_file
+        return response.make_conditional(request, accept_ranges=True, complete_length=size)
     except Exception:
+        if tmp is not None:
+            tmp.close()
         return jsonify({'error': 'Не удалось сформировать Excel'}), 500
 
 if __name__ == '__main__':